@@ -0,0 +1,167 @@
+import asyncio
+
+from sqlalchemy import event, func, insert, text, Column, Integer, String, DateTime, Boolean
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
+
+
+# One engine and one session factory for the whole app — every module that
+# touches leads.db must import these instead of creating its own.
+# WAL mode (set below) supports many readers alongside the writer, so a real
+# pool genuinely parallelizes the admin/export/read load. The busy timeout
+# keeps a briefly-locked write from erroring instead of waiting.
+engine = create_async_engine(
+    "sqlite+aiosqlite:///./leads.db",
+    connect_args={"timeout": 30},
+    pool_size=8,
+    max_overflow=16,
+    pool_recycle=1800,
+)
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+Base = declarative_base()
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, _):
+    # WAL lets readers run alongside the writer; NORMAL sync is safe in WAL
+    # mode and skips the fsync-per-commit that dominates /submit_paid
+    cur = dbapi_conn.cursor()
+    for pragma in (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA cache_size=-65536",
+    ):
+        cur.execute(pragma)
+    cur.close()
+
+
+class Lead(Base):
+    __tablename__ = "leads"
+
+    id = Column(Integer, primary_key=True, index=True)
+
+    name = Column(String, nullable=False)
+    email = Column(String, nullable=False)
+    message = Column(String, nullable=False)
+
+    # Server-side default: SQLite stamps it in-transaction, no Python datetime per insert
+    created_at = Column(DateTime, server_default=func.current_timestamp(), nullable=False)
+    source = Column(String, nullable=False, default="web")
+
+    paid = Column(Boolean, nullable=False, default=False)
+    stripe_session_id = Column(String, nullable=True, unique=True, index=True)
+    paid_at = Column(DateTime, nullable=True)
+
+
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        # Databases created before the index existed won't get it from create_all
+        await conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_leads_stripe_session_id "
+            "ON leads (stripe_session_id)"
+        ))
+
+
+# --------------------
+# Write coalescer
+# --------------------
+# Each submit used to pay one commit (one fsync) per lead. Queue inserts and
+# flush them in a single INSERT ... RETURNING whenever 100 rows are waiting or
+# the oldest has waited 50 ms, so burst throughput scales with batch size.
+_BATCH_MAX = 100
+_BATCH_WINDOW = 0.05  # seconds
+
+_write_queue = None
+_writer_task = None
+
+
+async def insert_lead(values: dict) -> int:
+    """
+    Queue one lead for insertion and wait for its new id.
+    """
+    if _write_queue is None:
+        raise RuntimeError("write coalescer is not running — call start_writer() first")
+    fut = asyncio.get_running_loop().create_future()
+    _write_queue.put_nowait((values, fut))
+    return await fut
+
+
+async def _flush(batch):
+    async with SessionLocal() as db:
+        try:
+            # sort_by_parameter_order makes the RETURNING ids line up with the
+            # batch — insertmanyvalues does not guarantee row order otherwise
+            ids = (
+                await db.execute(
+                    insert(Lead).returning(Lead.id, sort_by_parameter_order=True),
+                    [values for values, _fut in batch],
+                )
+            ).scalars().all()
+            await db.commit()
+        except Exception:
+            # One bad row (e.g. duplicate stripe_session_id) poisons the whole
+            # batch — retry row by row so only the offender fails.
+            await db.rollback()
+            for values, fut in batch:
+                try:
+                    lead_id = (
+                        await db.execute(insert(Lead).values(**values).returning(Lead.id))
+                    ).scalar_one()
+                    await db.commit()
+                except Exception as exc:
+                    await db.rollback()
+                    if not fut.cancelled():
+                        fut.set_exception(exc)
+                else:
+                    if not fut.cancelled():
+                        fut.set_result(lead_id)
+            return
+
+    for (_values, fut), lead_id in zip(batch, ids):
+        if not fut.cancelled():
+            fut.set_result(lead_id)
+
+
+async def _drain_batches():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _write_queue.get()]
+        deadline = loop.time() + _BATCH_WINDOW
+        while len(batch) < _BATCH_MAX:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_write_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await _flush(batch)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            # A failure outside _flush's own handling must not kill the
+            # consumer — fail this batch's waiters and keep draining
+            for _values, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+
+
+def start_writer():
+    global _write_queue, _writer_task
+    _write_queue = asyncio.Queue()
+    _writer_task = asyncio.create_task(_drain_batches())
+
+
+async def stop_writer():
+    global _writer_task
+    if _writer_task is not None:
+        _writer_task.cancel()
+        try:
+            await _writer_task
+        except asyncio.CancelledError:
+            pass
+        _writer_task = None
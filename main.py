@@ -1,11 +1,23 @@
+import asyncio
+import csv
+import gzip
+import hashlib
+import hmac
+import io
 import os
+import re
+import secrets
+import time
 from datetime import datetime
+from html import escape
 
 import stripe
 from fastapi import FastAPI, Form, HTTPException, Request
-from fastapi.responses import HTMLResponse, RedirectResponse
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean
-from sqlalchemy.orm import declarative_base, sessionmaker
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from db import Lead, SessionLocal, init_db, insert_lead, start_writer, stop_writer
 
 
 # --------------------
@@ -23,6 +35,14 @@ if not STRIPE_SECRET_KEY:
 
 stripe.api_key = STRIPE_SECRET_KEY
 
+# One pooled requests.Session for all Stripe calls — without it each call can
+# pay a fresh ~50-100 ms TLS handshake to api.stripe.com
+stripe.default_http_client = stripe.RequestsClient(timeout=10)
+
+# Signs the paid_sid cookie. The random fallback just means cookies stop
+# verifying across restarts and we fall back to asking Stripe again.
+COOKIE_SECRET = os.getenv("APP_SECRET", "") or secrets.token_hex(32)
+
 
 # --------------------
 # App
@@ -31,40 +51,76 @@ app = FastAPI()
 
 
 # --------------------
-# Database setup
+# Database setup (shared layer in db.py)
 # --------------------
-engine = create_engine(
-    "sqlite:///./leads.db",
-    connect_args={"check_same_thread": False}
-)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
-Base = declarative_base()
+@app.on_event("startup")
+async def on_startup():
+    await init_db()
+    start_writer()
 
 
-class Lead(Base):
-    __tablename__ = "leads"
+@app.on_event("shutdown")
+async def on_shutdown():
+    await stop_writer()
 
-    id = Column(Integer, primary_key=True, index=True)
 
-    name = Column(String, nullable=False)
-    email = Column(String, nullable=False)
-    message = Column(String, nullable=False)
+# --------------------
+# Helpers
+# --------------------
+# The Checkout payload only depends on PRICE_CENTS/BASE_URL, both fixed at
+# import — build it once; only the returned session.url varies per request
+_CHECKOUT_LINE_ITEMS = [{
+    "price_data": {
+        "currency": "usd",
+        "product_data": {"name": "Lead Intake Submission"},
+        "unit_amount": PRICE_CENTS,
+    },
+    "quantity": 1,
+}]
+_CHECKOUT_SUCCESS_URL = f"{BASE_URL}/intake?session_id={{CHECKOUT_SESSION_ID}}"
+_CHECKOUT_CANCEL_URL = f"{BASE_URL}/"
+_CHECKOUT_METADATA = {"product": "paid_lead_intake"}
 
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
-    source = Column(String, nullable=False, default="web")
 
-    paid = Column(Boolean, nullable=False, default=False)
-    stripe_session_id = Column(String, nullable=True, unique=True)
-    paid_at = Column(DateTime, nullable=True)
+# Good enough for intake volume — full RFC validation (email-validator et al.)
+# costs far more per POST than this single compiled match
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
 
 
-Base.metadata.create_all(bind=engine)
+def _sign_sid(session_id: str) -> str:
+    return hmac.new(COOKIE_SECRET.encode(), session_id.encode(), hashlib.sha256).hexdigest()
 
 
-# --------------------
-# Helpers
-# --------------------
-def require_paid_session(session_id: str) -> stripe.checkout.Session:
+class _CsvChunker:
+    """
+    File-like sink for csv.writer that accumulates UTF-8 bytes directly,
+    skipping the StringIO -> getvalue -> encode copies per chunk.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write(self, s: str):
+        self.buf.extend(s.encode("utf-8"))
+
+    def drain(self) -> bytes:
+        chunk = bytes(self.buf)
+        self.buf.clear()
+        return chunk
+
+
+# A Checkout session is immutable once paid, so cache verified sessions and
+# spare the second Stripe round-trip between GET /intake and POST /submit_paid.
+_PAID_CACHE_TTL = 15 * 60  # seconds
+_PAID_CACHE_MAX = 1024
+_paid_cache: dict[str, tuple[float, stripe.checkout.Session]] = {}
+_paid_cache_locks: dict[str, asyncio.Lock] = {}
+
+# session_ids currently queued in the write coalescer (see db.insert_lead)
+_pending_paid_sessions: set[str] = set()
+
+
+async def require_paid_session(session_id: str) -> stripe.checkout.Session:
     """
     Verifies this Stripe Checkout session is PAID.
     """
@@ -73,54 +129,44 @@ def require_paid_session(session_id: str) -> stripe.checkout.Session:
     if not session_id or len(session_id.strip()) < 10:
         raise HTTPException(status_code=400, detail="Missing or invalid session_id")
 
-    try:
-        session = stripe.checkout.Session.retrieve(session_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid Stripe session")
-
-    if session.payment_status != "paid":
-        raise HTTPException(status_code=402, detail="Payment not completed")
-
-    return session
+    cached = _paid_cache.get(session_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    # Coalesce concurrent lookups for the same session into one API call
+    lock = _paid_cache_locks.setdefault(session_id, asyncio.Lock())
+    async with lock:
+        cached = _paid_cache.get(session_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        try:
+            # stripe-python is blocking; keep it off the event loop
+            session = await asyncio.to_thread(stripe.checkout.Session.retrieve, session_id)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid Stripe session")
+        finally:
+            _paid_cache_locks.pop(session_id, None)
+
+        if session.payment_status != "paid":
+            # Unpaid sessions may still become paid — never cache those
+            raise HTTPException(status_code=402, detail="Payment not completed")
+
+        now = time.monotonic()
+        if len(_paid_cache) >= _PAID_CACHE_MAX:
+            for sid, (expires, _s) in list(_paid_cache.items()):
+                if expires <= now:
+                    _paid_cache.pop(sid, None)
+        while len(_paid_cache) >= _PAID_CACHE_MAX:
+            _paid_cache.pop(next(iter(_paid_cache)))
+        _paid_cache[session_id] = (now + _PAID_CACHE_TTL, session)
+        return session
 
 
 # --------------------
-# Routes
+# Pages (rendered once at import — nothing here changes per request)
 # --------------------
-@app.get("/health")
-def health_check():
-    return {"status": "ok"}
-
-@app.get("/debug/base-url")
-def debug_base_url(key: str):
-    if key != os.getenv("ADMIN_KEY"):
-        raise HTTPException(status_code=401, detail="nope")
-  
-    return {
-        "APP_BASE_URL_env": os.getenv("APP_BASE_URL"),
-        "BASE_URL_VAR_USED": BASE_URL
-    }
-
-@app.get("/stripe-test")
-def stripe_test():
-    if not stripe.api_key:
-        raise HTTPException(status_code=500, detail="Missing STRIPE_SECRET_KEY env var")
-
-    try:
-        bal = stripe.Balance.retrieve()
-        return {
-            "ok": True,
-            "livemode": bal.get("livemode"),
-            "available": bal.get("available", []),
-            "pending": bal.get("pending", []),
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-@app.get("/", response_class=HTMLResponse)
-def home():
-    dollars = PRICE_CENTS / 100
-    return f"""
+_HOME_HTML = f"""
     <html>
       <head>
         <title>Lead Intake (Paid)</title>
@@ -135,7 +181,7 @@ def home():
       <body>
         <h1>✅ Paid Lead Intake</h1>
         <div class="box">
-          <p><b>Pay ${dollars:.2f}</b> to submit a serious request.</p>
+          <p><b>Pay ${PRICE_CENTS / 100:.2f}</b> to submit a serious request.</p>
           <form action="/create-checkout-session" method="post">
             <button type="submit">Pay & Continue</button>
           </form>
@@ -147,50 +193,22 @@ def home():
         </p>
       </body>
     </html>
-    """
-
-
-@app.post("/create-checkout-session")
-def create_checkout_session():
-    if not STRIPE_SECRET_KEY:
-        raise HTTPException(status_code=500, detail="Stripe not configured (missing STRIPE_SECRET_KEY)")
+    """.encode("utf-8")
 
-    success_url = f"{BASE_URL}/intake?session_id={{CHECKOUT_SESSION_ID}}"
-    cancel_url  = f"{BASE_URL}/"
-
-    session = stripe.checkout.Session.create(
-        mode="payment",
-        line_items=[{
-            "price_data": {
-                "currency": "usd",
-                "product_data": {"name": "Lead Intake Submission"},
-                "unit_amount": PRICE_CENTS
-            },
-            "quantity": 1
-        }],
-        success_url=success_url,
-        cancel_url=cancel_url,
-        metadata={"product": "paid_lead_intake"}
-    )
-
-    return RedirectResponse(url=session.url, status_code=303)
-
-
-@app.get("/intake", response_class=HTMLResponse)
-def intake(session_id: str):
-    # Must be paid to view form
-    require_paid_session(session_id)
-
-    return f"""
+# The intake page only varies by session_id; pre-split around it so the
+# handler just glues three byte strings together.
+_INTAKE_PREFIX, _INTAKE_SUFFIX = (
+    part.encode("utf-8")
+    for part in """
     <html>
       <head>
         <title>Paid Intake Form</title>
         <meta name="viewport" content="width=device-width, initial-scale=1" />
         <style>
-          body {{ font-family: Arial, sans-serif; max-width: 720px; margin: 40px auto; padding: 0 16px; }}
-          input, textarea {{ width: 100%; padding: 10px; margin: 8px 0; }}
-          button {{ padding: 12px 16px; font-size: 16px; cursor: pointer; }}
-          .small {{ color:#666; font-size: 14px; }}
+          body { font-family: Arial, sans-serif; max-width: 720px; margin: 40px auto; padding: 0 16px; }
+          input, textarea { width: 100%; padding: 10px; margin: 8px 0; }
+          button { padding: 12px 16px; font-size: 16px; cursor: pointer; }
+          .small { color:#666; font-size: 14px; }
         </style>
       </head>
       <body>
@@ -198,7 +216,7 @@ def intake(session_id: str):
         <p class="small">Payment verified ✅</p>
 
         <form action="/submit_paid" method="post">
-          <input type="hidden" name="session_id" value="{session_id}" />
+          <input type="hidden" name="session_id" value="@SESSION_ID@" />
 
           <label>Name</label>
           <input name="name" required minlength="2" />
@@ -215,54 +233,263 @@ def intake(session_id: str):
         <p class="small">If you refresh this page later, it will still work as long as the session is paid and unused.</p>
       </body>
     </html>
-    """
+    """.split("@SESSION_ID@")
+)
+
+# Admin page pre-split around its two dynamic slots (total count, table rows)
+# — only those are built per request
+_ADMIN_P1, _ADMIN_P2, _ADMIN_SUFFIX = (
+    part.encode("utf-8")
+    for part in """
+    <html>
+      <head>
+        <title>Leads Admin</title>
+        <meta name="viewport" content="width=device-width, initial-scale=1" />
+        <style>
+          body { font-family: Arial, sans-serif; max-width: 960px; margin: 40px auto; padding: 0 16px; }
+          table { width: 100%; border-collapse: collapse; }
+          th, td { border-bottom: 1px solid #ddd; padding: 8px; text-align: left; vertical-align: top; }
+          .muted { color:#666; font-size: 13px; }
+        </style>
+      </head>
+      <body>
+        <h1>Leads (latest 50 of @SLOT@)</h1>
+        <p class="muted"><a href="/export.csv?key=">Export CSV</a> (append your key)</p>
+        <table>
+          <tr><th>ID</th><th>Who</th><th>Message</th></tr>
+          @SLOT@
+        </table>
+      </body>
+    </html>
+    """.split("@SLOT@")
+)
+# Bytes template (PEP 461): rows interpolate straight to bytes, no per-page
+# unicode encoding pass over the joined result
+_ADMIN_ROW = b"<tr><td>%d</td><td>%s<br><span class='muted'>%s</span></td><td>%s</td></tr>"
+
+
+# --------------------
+# Routes
+# --------------------
+@app.get("/health")
+async def health_check():
+    return {"status": "ok"}
+
+@app.get("/debug/base-url")
+async def debug_base_url(key: str):
+    if key != os.getenv("ADMIN_KEY"):
+        raise HTTPException(status_code=401, detail="nope")
+  
+    return {
+        "APP_BASE_URL_env": os.getenv("APP_BASE_URL"),
+        "BASE_URL_VAR_USED": BASE_URL
+    }
+
+@app.get("/stripe-test")
+async def stripe_test():
+    if not stripe.api_key:
+        raise HTTPException(status_code=500, detail="Missing STRIPE_SECRET_KEY env var")
+
+    try:
+        bal = await asyncio.to_thread(stripe.Balance.retrieve)
+        return {
+            "ok": True,
+            "livemode": bal.get("livemode"),
+            "available": bal.get("available", []),
+            "pending": bal.get("pending", []),
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/admin")
+async def admin_page(key: str):
+    if key != os.getenv("ADMIN_KEY"):
+        raise HTTPException(status_code=401, detail="nope")
+
+    async def recent():
+        async with SessionLocal() as db:
+            # Only the rendered columns — no full ORM instances for a read-only table
+            return (
+                await db.execute(
+                    select(Lead.id, Lead.name, Lead.email, Lead.message)
+                    .order_by(Lead.id.desc())
+                    .limit(50)
+                )
+            ).all()
+
+    async def total():
+        async with SessionLocal() as db:
+            return await db.scalar(select(func.count(Lead.id)))
+
+    # One session per coroutine — async sessions aren't concurrency-safe
+    leads, count = await asyncio.gather(recent(), total())
+
+    rows = b"".join([
+        _ADMIN_ROW % (
+            lead_id,
+            escape(name).encode("utf-8"),
+            escape(email).encode("utf-8"),
+            escape(message).encode("utf-8"),
+        )
+        for lead_id, name, email, message in leads
+    ]) or b"<tr><td colspan='3' class='muted'>No leads yet</td></tr>"
+
+    return Response(
+        _ADMIN_P1 + str(count).encode("utf-8") + _ADMIN_P2 + rows + _ADMIN_SUFFIX,
+        media_type="text/html",
+    )
+
+
+@app.get("/export.csv")
+async def export_csv(key: str, request: Request):
+    if key != os.getenv("ADMIN_KEY"):
+        raise HTTPException(status_code=401, detail="nope")
+
+    async def gen():
+        # One reusable buffer; never hold more than one 1000-row chunk in memory
+        chunker = _CsvChunker()
+        writer = csv.writer(chunker)
+        writer.writerow(["id", "created_at", "source", "paid", "name", "email", "message"])
+        async with SessionLocal() as db:
+            # Plain Row tuples — ORM hydration is pure overhead for a CSV dump
+            result = await db.stream(
+                select(
+                    Lead.id, Lead.created_at, Lead.source, Lead.paid,
+                    Lead.name, Lead.email, Lead.message,
+                )
+                .order_by(Lead.id.desc())
+                .execution_options(stream_results=True, yield_per=1000)
+            )
+            async for chunk in result.partitions(1000):
+                writer.writerows(chunk)
+                yield chunker.drain()
+        if chunker.buf:
+            yield chunker.drain()
+
+    headers = {"Content-Disposition": "attachment; filename=leads.csv"}
+
+    # CSV of leads compresses ~5-10x; level 1 keeps it near line speed
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        async def gzipped():
+            raw = io.BytesIO()
+            gz = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=1)
+            async for chunk in gen():
+                gz.write(chunk)
+                if raw.tell():
+                    yield raw.getvalue()
+                    raw.seek(0)
+                    raw.truncate(0)
+            gz.close()
+            if raw.tell():
+                yield raw.getvalue()
+
+        headers["Content-Encoding"] = "gzip"
+        return StreamingResponse(gzipped(), media_type="text/csv", headers=headers)
+
+    return StreamingResponse(gen(), media_type="text/csv", headers=headers)
+
+
+@app.get("/")
+async def home():
+    return Response(_HOME_HTML, media_type="text/html")
+
+
+@app.post("/create-checkout-session")
+async def create_checkout_session():
+    if not STRIPE_SECRET_KEY:
+        raise HTTPException(status_code=500, detail="Stripe not configured (missing STRIPE_SECRET_KEY)")
+
+    session = await asyncio.to_thread(
+        stripe.checkout.Session.create,
+        mode="payment",
+        line_items=_CHECKOUT_LINE_ITEMS,
+        success_url=_CHECKOUT_SUCCESS_URL,
+        cancel_url=_CHECKOUT_CANCEL_URL,
+        metadata=_CHECKOUT_METADATA,
+    )
+
+    return RedirectResponse(url=session.url, status_code=303)
+
+
+@app.get("/intake")
+async def intake(session_id: str, request: Request):
+    # A valid signed cookie proves we already verified this session with
+    # Stripe, so page reloads skip the API round-trip entirely
+    cookie_sid, _, cookie_sig = request.cookies.get("paid_sid", "").rpartition(".")
+    verified = cookie_sid == session_id and hmac.compare_digest(
+        cookie_sig, _sign_sid(session_id)
+    )
+
+    if not verified:
+        # Must be paid to view form
+        await require_paid_session(session_id)
+
+    response = Response(
+        _INTAKE_PREFIX + session_id.encode("utf-8") + _INTAKE_SUFFIX,
+        media_type="text/html",
+    )
+    if not verified:
+        response.set_cookie(
+            "paid_sid",
+            f"{session_id}.{_sign_sid(session_id)}",
+            max_age=3600,
+            httponly=True,
+            samesite="strict",
+        )
+    return response
 
 
 @app.post("/submit_paid", response_class=HTMLResponse)
-def submit_paid(
+async def submit_paid(
     session_id: str = Form(...),
     name: str = Form(...),
     email: str = Form(...),
     message: str = Form(...),
 ):
     # Confirm payment
-    require_paid_session(session_id)
+    await require_paid_session(session_id)
 
     # Cheap validation
     if len(name.strip()) < 2:
         raise HTTPException(status_code=400, detail="Name too short")
+    if not _EMAIL_RE.match(email.strip()):
+        raise HTTPException(status_code=400, detail="Invalid email")
     if len(message.strip()) < 10:
         raise HTTPException(status_code=400, detail="Message too short")
 
-    db = SessionLocal()
+    # Don't let the same session_id sit in the write queue twice
+    if session_id in _pending_paid_sessions:
+        raise HTTPException(status_code=409, detail="This payment session was already used.")
+    _pending_paid_sessions.add(session_id)
     try:
-        # Prevent re-using same paid session_id multiple times
-        exists = db.query(Lead).filter(Lead.stripe_session_id == session_id).first()
-        if exists:
+        lead_id = await insert_lead({
+            "name": name.strip(),
+            "email": email.strip(),
+            "message": message.strip(),
+            # Databases created before the server_default migration have no
+            # DEFAULT on created_at, so always supply it explicitly
+            "created_at": datetime.utcnow(),
+            "source": "web_paid",
+            "paid": True,
+            "stripe_session_id": session_id,
+            "paid_at": datetime.utcnow(),
+        })
+    except IntegrityError as exc:
+        # Unique index on stripe_session_id: same paid session used twice.
+        # Any other constraint failure is a real bug — let it surface as a 500.
+        if "stripe_session_id" in str(exc.orig):
             raise HTTPException(status_code=409, detail="This payment session was already used.")
-
-        row = Lead(
-            name=name.strip(),
-            email=email.strip(),
-            message=message.strip(),
-            source="web_paid",
-            paid=True,
-            stripe_session_id=session_id,
-            paid_at=datetime.utcnow(),
-        )
-        db.add(row)
-        db.commit()
-        db.refresh(row)
-
-        return f"""
-        <html>
-          <head><meta name="viewport" content="width=device-width, initial-scale=1" /></head>
-          <body style="font-family: Arial; max-width:720px; margin:40px auto; padding:0 16px;">
-            <h1>✅ Submitted</h1>
-            <p>Your request is in. Lead ID: <b>{row.id}</b></p>
-            <p><a href="/">Back to home</a></p>
-          </body>
-        </html>
-        """
+        raise
     finally:
-        db.close()
+        _pending_paid_sessions.discard(session_id)
+
+    return f"""
+    <html>
+      <head><meta name="viewport" content="width=device-width, initial-scale=1" /></head>
+      <body style="font-family: Arial; max-width:720px; margin:40px auto; padding:0 16px;">
+        <h1>✅ Submitted</h1>
+        <p>Your request is in. Lead ID: <b>{lead_id}</b></p>
+        <p><a href="/">Back to home</a></p>
+      </body>
+    </html>
+    """